@@ -1,5 +1,6 @@
 import os
 import json
+import asyncio
 from datetime import date, time
 from dotenv import load_dotenv
 
@@ -19,7 +20,17 @@ from telegram.ext import (
     filters,
 )
 
-from sheets import add_gasto, add_ingreso, leer_transacciones
+from sheets import (
+    add_gasto,
+    add_ingreso,
+    leer_transacciones,
+    get_movimiento,
+    listar_movimientos,
+    ultimo_movimiento,
+    editar_movimiento,
+    borrar_movimiento,
+)
+from reports import generar_informe, periodos_disponibles, shutdown_pool
 
 # ============================================================
 #                   CONFIGURACIÓN INICIAL
@@ -105,6 +116,9 @@ def build_days_keyboard(prefix):
         rows.append(r)
     return InlineKeyboardMarkup(rows)
 
+def describe_movimiento(m):
+    return f"{m['tipo']} — {m['importe']}€ — {m['fecha']}\n{m['descripcion']} ({m['categoria']}) · fila {m['fila']}"
+
 # ============================================================
 #                          START
 # ============================================================
@@ -121,6 +135,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("➖ Registrar Gasto", callback_data="menu_gasto")],
         [InlineKeyboardButton("➕ Registrar Ingreso", callback_data="menu_ingreso")],
         [InlineKeyboardButton("⚙ Programados", callback_data="menu_programados")],
+        [InlineKeyboardButton("↩ Deshacer último", callback_data="mov_undo")],
+        [InlineKeyboardButton("✏ Editar movimiento", callback_data="mov_edit")],
     ]
 
     await msg.reply_text("Menú principal:", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -160,6 +176,41 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("Selecciona:", reply_markup=InlineKeyboardMarkup(keyboard))
         return
 
+    # --------------------------------------------------------
+    # INFORMES (BALANCE MENSUAL / ANUAL)
+    # --------------------------------------------------------
+    if data == "vd_balance":
+        # El periodo va en el callback (rep_2026-09_csv, rep_2026_pdf):
+        # así se puede exportar el mes o el año ya cerrados
+        kb = []
+        for etiqueta, periodo in periodos_disponibles(date.today()):
+            fmt_grafico = "png" if len(periodo) == 7 else "pdf"
+            kb.append([
+                InlineKeyboardButton(f"📄 CSV {etiqueta.lower()} ({periodo})", callback_data=f"rep_{periodo}_csv"),
+                InlineKeyboardButton(f"📊 Gráfico ({fmt_grafico.upper()})", callback_data=f"rep_{periodo}_{fmt_grafico}"),
+            ])
+        await query.message.reply_text("Informe:", reply_markup=InlineKeyboardMarkup(kb))
+        return
+
+    if data.startswith("rep_"):
+        _, periodo, fmt = data.split("_")
+        await query.message.reply_text("Generando informe...")
+
+        try:
+            nombre, contenido, descartados = await generar_informe(periodo, fmt)
+        except Exception as e:
+            await query.message.reply_text(f"Error generando informe: {e}", reply_markup=build_main_menu())
+            return
+
+        aviso = None
+        if descartados:
+            aviso = f"⚠ {descartados} fila(s) sin fecha o importe válidos no se han incluido."
+
+        await query.message.reply_document(
+            document=contenido, filename=nombre, caption=aviso, reply_markup=build_main_menu()
+        )
+        return
+
     # --------------------------------------------------------
     # REGISTRO NORMAL GASTO / INGRESO
     # --------------------------------------------------------
@@ -424,6 +475,96 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.message.reply_text("Día actualizado.", reply_markup=build_main_menu())
         return
 
+    # --------------------------------------------------------
+    # DESHACER / EDITAR MOVIMIENTOS REGISTRADOS
+    # --------------------------------------------------------
+    if data == "mov_undo":
+        m = ultimo_movimiento()
+        if not m:
+            await query.message.reply_text("No hay movimientos recientes.", reply_markup=build_main_menu())
+            return
+
+        kb = [
+            [InlineKeyboardButton("🗑 Borrar", callback_data=f"movdel_{m['id']}")],
+            [InlineKeyboardButton("❌ Cancelar", callback_data="menu_main")],
+        ]
+        await query.message.reply_text(
+            f"¿Deshacer el último movimiento?\n\n{describe_movimiento(m)}",
+            reply_markup=InlineKeyboardMarkup(kb)
+        )
+        return
+
+    if data == "mov_edit":
+        movs = listar_movimientos(10)
+        if not movs:
+            await query.message.reply_text("No hay movimientos recientes.", reply_markup=build_main_menu())
+            return
+
+        kb = [
+            [InlineKeyboardButton(f"{m['fecha']} · {m['tipo']} · {m['importe']}€ · {m['categoria']}",
+                                  callback_data=f"movsel_{m['id']}")]
+            for m in movs
+        ]
+        await query.message.reply_text("Selecciona movimiento:", reply_markup=InlineKeyboardMarkup(kb))
+        return
+
+    if data.startswith("movsel_"):
+        tx_id = int(data.removeprefix("movsel_"))
+        m = get_movimiento(tx_id)
+        if not m:
+            await query.message.reply_text("Movimiento no encontrado.")
+            return
+
+        USER_STATE[user_id] = {"modo": "edit_mov", "mov_id": tx_id}
+
+        kb = [
+            [InlineKeyboardButton("Importe", callback_data="movf_importe")],
+            [InlineKeyboardButton("Categoría", callback_data="movf_categoria")],
+            [InlineKeyboardButton("Descripción", callback_data="movf_desc")],
+            [InlineKeyboardButton("🗑 Borrar", callback_data=f"movdel_{tx_id}")],
+        ]
+        await query.message.reply_text(
+            f"{describe_movimiento(m)}\n\n¿Qué quieres cambiar?",
+            reply_markup=InlineKeyboardMarkup(kb)
+        )
+        return
+
+    if data.startswith("movf_"):
+        field = data.removeprefix("movf_")
+        m = get_movimiento(st["mov_id"]) if st.get("mov_id") else None
+        if not m:
+            await query.message.reply_text("Movimiento no encontrado.")
+            return
+
+        st["step"] = field
+        USER_STATE[user_id] = st
+
+        if field == "categoria":
+            await query.message.reply_text("Nueva categoría:",
+                reply_markup=build_categories_keyboard(m["tipo"], "movcat_"))
+            return
+
+        await query.message.reply_text("Introduce el nuevo valor:")
+        return
+
+    if data.startswith("movcat_"):
+        if not st.get("mov_id"):
+            await query.message.reply_text("Movimiento no encontrado.", reply_markup=build_main_menu())
+            return
+
+        ok = await asyncio.to_thread(editar_movimiento, st["mov_id"], "categoria", data.removeprefix("movcat_"))
+        USER_STATE[user_id] = {}
+        msg = "Categoría actualizada." if ok else "Movimiento no encontrado."
+        await query.message.reply_text(msg, reply_markup=build_main_menu())
+        return
+
+    if data.startswith("movdel_"):
+        ok = await asyncio.to_thread(borrar_movimiento, int(data.removeprefix("movdel_")))
+        USER_STATE[user_id] = {}
+        msg = "Movimiento eliminado." if ok else "Movimiento no encontrado."
+        await query.message.reply_text(msg, reply_markup=build_main_menu())
+        return
+
     # --------------------------------------------------------
     # REGISTRO NORMAL: Categoría / Método / Confirmación
     # --------------------------------------------------------
@@ -464,13 +605,17 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "conf_si":
         hoy = date.today()
         if st["tipo"] == "Gasto":
-            add_gasto(hoy, st["importe"], st["descripcion"], st["categoria"])
+            tx_id, fila = await asyncio.to_thread(add_gasto, hoy, st["importe"], st["descripcion"], st["categoria"])
         else:
-            add_ingreso(hoy, st["importe"], st["descripcion"], st["categoria"])
+            tx_id, fila = await asyncio.to_thread(add_ingreso, hoy, st["importe"], st["descripcion"], st["categoria"])
 
         USER_STATE[user_id] = {}
 
-        await query.message.reply_text("Guardado!", reply_markup=build_main_menu())
+        kb = [
+            [InlineKeyboardButton("↩ Deshacer", callback_data=f"movdel_{tx_id}")],
+            [InlineKeyboardButton("⬅ Menú principal", callback_data="menu_main")],
+        ]
+        await query.message.reply_text(f"Guardado! (fila {fila})", reply_markup=InlineKeyboardMarkup(kb))
         return
 
     if data == "conf_no":
@@ -540,6 +685,30 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("Descripción actualizada.", reply_markup=build_main_menu())
             return
 
+    # ---- EDITAR MOVIMIENTO ----
+    if st.get("modo") == "edit_mov":
+        if st.get("step") == "importe":
+            try:
+                valor = float(text.replace(",", "."))
+            except:
+                await update.message.reply_text("Importe inválido.")
+                return
+            ok = await asyncio.to_thread(editar_movimiento, st["mov_id"], "importe", valor)
+            USER_STATE[user_id] = {}
+            msg = "Importe actualizado." if ok else "Movimiento no encontrado."
+            await update.message.reply_text(msg, reply_markup=build_main_menu())
+            return
+
+        if st.get("step") == "desc":
+            ok = await asyncio.to_thread(editar_movimiento, st["mov_id"], "descripcion", text)
+            USER_STATE[user_id] = {}
+            msg = "Descripción actualizada." if ok else "Movimiento no encontrado."
+            await update.message.reply_text(msg, reply_markup=build_main_menu())
+            return
+
+        await update.message.reply_text("Selecciona un campo a editar.")
+        return
+
     # ---- REGISTRO NORMAL ----
     if "importe" not in st:
         try:
@@ -571,9 +740,9 @@ async def ejecutar_programados(context):
         if p["dia"] == hoy.day:
             desc = f"{p['descripcion']} · {p['metodo']}"
             if p["tipo"].lower() == "gasto":
-                add_gasto(hoy, p["importe"], desc, p["categoria"])
+                await asyncio.to_thread(add_gasto, hoy, p["importe"], desc, p["categoria"])
             else:
-                add_ingreso(hoy, p["importe"], desc, p["categoria"])
+                await asyncio.to_thread(add_ingreso, hoy, p["importe"], desc, p["categoria"])
 
 # ============================================================
 #                           MAIN
@@ -591,7 +760,10 @@ def main():
     application.job_queue.run_daily(ejecutar_programados, time(7, 0))
 
     print("Bot iniciado con polling (PTB 21 + Python 3.13)")
-    application.run_polling(close_loop=False)
+    try:
+        application.run_polling(close_loop=False)
+    finally:
+        shutdown_pool()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+import io
+import csv
+import json
+import asyncio
+import re
+import hashlib
+import multiprocessing
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from sheets import leer_transacciones, EPOCH_SHEETS
+
+# ============================================================
+#                   CONFIGURACIÓN INICIAL
+# ============================================================
+
+MESES = [
+    "Ene", "Feb", "Mar", "Abr", "May", "Jun",
+    "Jul", "Ago", "Sep", "Oct", "Nov", "Dic"
+]
+
+FORMATOS = ["csv", "png", "pdf"]
+
+MAX_WORKERS = 2
+MAX_CACHE = 32
+
+_POOL = None
+_CACHE = {}
+
+# ============================================================
+#                       HELPERS
+# ============================================================
+
+def get_pool():
+    # El pool se crea al primer uso para no lanzar procesos al importar.
+    # "spawn" evita hacer fork de un proceso que ya tiene hilos (to_thread)
+    # con locks de SSL/logging tomados.
+    global _POOL
+    if _POOL is None:
+        _POOL = ProcessPoolExecutor(
+            max_workers=MAX_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _POOL
+
+def shutdown_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(wait=False, cancel_futures=True)
+        _POOL = None
+
+def _es_numero(valor):
+    return isinstance(valor, (int, float)) and not isinstance(valor, bool)
+
+def _fecha_de_serial(valor):
+    return EPOCH_SHEETS + timedelta(days=int(valor))
+
+def _normalizar(filas, tipo, periodo):
+    """
+    Convierte filas leídas con leer_transacciones(sin_formato=True)
+    y se queda con las del periodo.
+    Devuelve (movimientos, descartados): se cuentan, no se adivinan, las filas
+    sin fecha numérica y las del periodo cuyo importe no es numérico.
+    """
+    movimientos = []
+    descartados = 0
+    for fila in filas:
+        if not any(str(v).strip() for v in fila):
+            continue
+        if not _es_numero(fila[0]):
+            descartados += 1
+            continue
+
+        fecha = _fecha_de_serial(fila[0]).isoformat()
+        if not fecha.startswith(periodo):
+            continue
+        if len(fila) < 2 or not _es_numero(fila[1]):
+            descartados += 1
+            continue
+
+        movimientos.append({
+            "fecha": fecha,
+            "tipo": tipo,
+            "importe": float(fila[1]),
+            "descripcion": str(fila[2]) if len(fila) > 2 else "",
+            "categoria": str(fila[3]) if len(fila) > 3 else "",
+        })
+    return movimientos, descartados
+
+def periodos_disponibles(hoy: date):
+    """
+    Devuelve [(etiqueta, clave)] de los periodos exportables:
+    mes y año actuales y anteriores. Claves "2024-05" (mes) o "2024" (año).
+    """
+    mes_anterior = date(hoy.year, hoy.month, 1) - timedelta(days=1)
+    return [
+        ("Mes actual", f"{hoy.year:04d}-{hoy.month:02d}"),
+        ("Mes anterior", f"{mes_anterior.year:04d}-{mes_anterior.month:02d}"),
+        ("Año actual", f"{hoy.year:04d}"),
+        ("Año anterior", f"{hoy.year - 1:04d}"),
+    ]
+
+def periodo_valido(periodo):
+    return re.fullmatch(r"\d{4}(-(0[1-9]|1[0-2]))?", periodo) is not None
+
+def filtrar_periodo(gastos, ingresos, periodo):
+    """Devuelve (movimientos del periodo, filas descartadas)."""
+    mov_g, desc_g = _normalizar(gastos, "Gasto", periodo)
+    mov_i, desc_i = _normalizar(ingresos, "Ingreso", periodo)
+    movimientos = mov_g + mov_i
+    movimientos.sort(key=lambda m: (m["fecha"], m["tipo"]))
+    return movimientos, desc_g + desc_i
+
+def data_version(movimientos):
+    raw = json.dumps(movimientos, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+def nombre_fichero(periodo, fmt):
+    return f"balance_{periodo}.{fmt}"
+
+# ============================================================
+#                 RENDERIZADO (PROCESS POOL)
+# ============================================================
+# Estas funciones se ejecutan en otro proceso: solo reciben y
+# devuelven datos serializables (listas, dicts, bytes).
+
+def render_csv(movimientos):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["Fecha", "Tipo", "Importe", "Descripción", "Categoría"])
+    for m in movimientos:
+        writer.writerow([m["fecha"], m["tipo"], f"{m['importe']:.2f}", m["descripcion"], m["categoria"]])
+
+    # BOM para que Excel detecte UTF-8 (tildes)
+    return buf.getvalue().encode("utf-8-sig")
+
+def render_chart(movimientos, periodo, fmt):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    total_gastos = sum(m["importe"] for m in movimientos if m["tipo"] == "Gasto")
+    total_ingresos = sum(m["importe"] for m in movimientos if m["tipo"] == "Ingreso")
+    titulo = (
+        f"Balance {periodo} — Ingresos {total_ingresos:.2f}€ · "
+        f"Gastos {total_gastos:.2f}€ · Saldo {total_ingresos - total_gastos:.2f}€"
+    )
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+
+    if len(periodo) == 7:
+        # Mensual: gastos por categoría
+        por_categoria = {}
+        for m in movimientos:
+            if m["tipo"] == "Gasto":
+                cat = m["categoria"] or "Otros"
+                por_categoria[cat] = por_categoria.get(cat, 0) + m["importe"]
+
+        cats = sorted(por_categoria, key=por_categoria.get)
+        ax.barh(cats, [por_categoria[c] for c in cats], color="tab:red")
+        ax.set_xlabel("€")
+        if not cats:
+            ax.text(0.5, 0.5, "Sin gastos", ha="center", va="center", transform=ax.transAxes)
+    else:
+        # Anual: ingresos / gastos por mes + saldo
+        ingresos = [0.0] * 12
+        gastos = [0.0] * 12
+        for m in movimientos:
+            mes = int(m["fecha"][5:7]) - 1
+            if m["tipo"] == "Gasto":
+                gastos[mes] += m["importe"]
+            else:
+                ingresos[mes] += m["importe"]
+
+        x = range(12)
+        ax.bar([i - 0.2 for i in x], ingresos, width=0.4, label="Ingresos", color="tab:green")
+        ax.bar([i + 0.2 for i in x], gastos, width=0.4, label="Gastos", color="tab:red")
+        ax.plot(list(x), [i - g for i, g in zip(ingresos, gastos)], marker="o", label="Saldo", color="tab:blue")
+        ax.axhline(0, color="grey", linewidth=0.8)
+        ax.set_xticks(list(x))
+        ax.set_xticklabels(MESES)
+        ax.set_ylabel("€")
+        ax.legend()
+
+    ax.set_title(titulo, fontsize=10)
+    fig.tight_layout()
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt)
+    plt.close(fig)
+    return buf.getvalue()
+
+def render(movimientos, periodo, fmt):
+    if fmt == "csv":
+        return render_csv(movimientos)
+    return render_chart(movimientos, periodo, fmt)
+
+# ============================================================
+#                     GENERAR INFORME
+# ============================================================
+
+def _leer_periodo(periodo):
+    # Lectura + normalización + hash: todo en el mismo hilo, fuera del loop
+    gastos, ingresos = leer_transacciones(sin_formato=True)
+    movimientos, descartados = filtrar_periodo(gastos, ingresos, periodo)
+    return movimientos, descartados, data_version(movimientos)
+
+def _reemplazar_pool(roto):
+    # Solo se rehace si nadie lo ha hecho ya: si otra tarea ya puso un pool
+    # nuevo, apagarlo cancelaría sus trabajos
+    global _POOL
+    if _POOL is roto:
+        _POOL = None
+        roto.shutdown(wait=False, cancel_futures=True)
+
+async def _render_en_pool(movimientos, periodo, fmt):
+    loop = asyncio.get_running_loop()
+    pool = get_pool()
+    try:
+        return await loop.run_in_executor(pool, render, movimientos, periodo, fmt)
+    except BrokenProcessPool:
+        # Un worker murió (OOM, crash de matplotlib): se rehace el pool
+        # y se reintenta una vez
+        _reemplazar_pool(pool)
+        pool = get_pool()
+        try:
+            return await loop.run_in_executor(pool, render, movimientos, periodo, fmt)
+        except BrokenProcessPool:
+            _reemplazar_pool(pool)
+            raise
+
+async def generar_informe(periodo, fmt):
+    """
+    Genera el informe del periodo ("2024-05" o "2024") sin bloquear el
+    event loop: la lectura de la hoja va a un hilo y el renderizado al
+    process pool. Devuelve (nombre_fichero, bytes, filas descartadas).
+    Se cachea por (periodo, formato, versión).
+    """
+    if fmt not in FORMATOS:
+        raise ValueError(f"Formato no soportado: {fmt}")
+    if not periodo_valido(periodo):
+        raise ValueError(f"Periodo no válido: {periodo}")
+
+    movimientos, descartados, version = await asyncio.to_thread(_leer_periodo, periodo)
+
+    key = (periodo, fmt, version)
+    if key in _CACHE:
+        return nombre_fichero(periodo, fmt), _CACHE[key], descartados
+
+    contenido = await _render_en_pool(movimientos, periodo, fmt)
+
+    # Las versiones antiguas de un periodo ya no sirven
+    for k in [k for k in _CACHE if k[:2] == key[:2]]:
+        del _CACHE[k]
+    if len(_CACHE) >= MAX_CACHE:
+        del _CACHE[next(iter(_CACHE))]
+    _CACHE[key] = contenido
+
+    return nombre_fichero(periodo, fmt), contenido, descartados
@@ -1,4 +1,8 @@
 import os
+import re
+import json
+import threading
+from datetime import date
 from dotenv import load_dotenv
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
@@ -10,19 +14,97 @@ SPREADSHEET_ID = os.environ.get("SHEET_ID")
 
 SERVICE_ACCOUNT_FILE = "service_account.json"
 
-def leer_transacciones():
+INDICE_FILE = "indice_transacciones.json"
+MAX_INDICE = 100
+
+# Columnas de cada bloque en la hoja: (primera, última)
+COLUMNAS = {"Gasto": ("B", "E"), "Ingreso": ("G", "J")}
+CAMPOS = ["fecha", "importe", "descripcion", "categoria"]
+
+# Día 0 de los números de serie de fecha de Google Sheets
+EPOCH_SHEETS = date(1899, 12, 30)
+
+# Protege el índice local (memoria + fichero). Las escrituras se lanzan
+# desde el bot con asyncio.to_thread, así que pueden solaparse en hilos
+_LOCK = threading.Lock()
+
+# ============================================================
+#                 ÍNDICE LOCAL DE MOVIMIENTOS
+# ============================================================
+
+def load_indice():
+    if not os.path.exists(INDICE_FILE):
+        return {"next_id": 1, "movs": {}}
+    try:
+        with open(INDICE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except:
+        return {"next_id": 1, "movs": {}}
+
+def save_indice(indice):
+    tmp = INDICE_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(indice, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, INDICE_FILE)
+
+INDICE = load_indice()
+
+def get_movimiento(tx_id):
+    mov = INDICE["movs"].get(str(tx_id))
+    if mov is None:
+        return None
+    return {"id": int(tx_id), **mov}
+
+def listar_movimientos(n=10):
+    """Últimos n movimientos registrados, del más reciente al más antiguo."""
+    # list() copia las claves de una vez: otro hilo puede estar escribiendo
+    ids = sorted((int(k) for k in list(INDICE["movs"])), reverse=True)[:n]
+    return [get_movimiento(i) for i in ids]
+
+def ultimo_movimiento():
+    movs = listar_movimientos(1)
+    return movs[0] if movs else None
+
+def _indexar(tipo, fila, valores):
+    tx_id = INDICE["next_id"]
+    INDICE["next_id"] = tx_id + 1
+    INDICE["movs"][str(tx_id)] = {"tipo": tipo, "fila": fila, **dict(zip(CAMPOS, valores))}
+
+    # Mantener el índice acotado: se descartan los más antiguos
+    sobrantes = sorted(int(k) for k in INDICE["movs"])[:-MAX_INDICE]
+    for k in sobrantes:
+        del INDICE["movs"][str(k)]
+
+    save_indice(INDICE)
+    return tx_id
+
+def leer_transacciones(sin_formato=False):
+    """
+    Devuelve (gastos, ingresos) como listas de filas.
+    Con sin_formato=True los importes llegan como números y las fechas
+    como número de serie de Sheets, en lugar de texto con formato local.
+    """
     service = get_sheets_service()
 
+    opciones = {}
+    if sin_formato:
+        opciones = {
+            "valueRenderOption": "UNFORMATTED_VALUE",
+            "dateTimeRenderOption": "SERIAL_NUMBER",
+        }
+
     # Gastos
     r1 = service.spreadsheets().values().get(
         spreadsheetId=SPREADSHEET_ID,
-        range="Transacciones!B5:E"
+        range="Transacciones!B5:E",
+        **opciones
     ).execute()
 
     # Ingresos
     r2 = service.spreadsheets().values().get(
         spreadsheetId=SPREADSHEET_ID,
-        range="Transacciones!G5:J"
+        range="Transacciones!G5:J",
+        **opciones
     ).execute()
 
     gastos = r1.get("values", [])
@@ -38,46 +120,153 @@ def get_sheets_service():
     return service
 
 
-def _find_next_row(service, col, start_row):
-    # CORRECCIÓN: agregar spreadsheetId obligatorio
-    result = service.spreadsheets().values().get(
+def _fila_de_rango(rango):
+    # "Transacciones!B12:E12" → 12
+    return int(re.search(r"!\D+(\d+)", rango).group(1))
+
+
+def _add_movimiento(tipo, fecha, importe, descripcion, categoria):
+    service = get_sheets_service()
+    col_ini, col_fin = COLUMNAS[tipo]
+    valores = [str(fecha), importe, descripcion, categoria]
+
+    # append elige la fila en el servidor de forma atómica; OVERWRITE
+    # escribe en la primera fila libre sin insertar filas nuevas, así
+    # que las filas ya indexadas no se desplazan
+    result = service.spreadsheets().values().append(
         spreadsheetId=SPREADSHEET_ID,
-        range=f"Transacciones!{col}{start_row}:{col}"
+        range=f"Transacciones!{col_ini}5:{col_fin}",
+        valueInputOption="USER_ENTERED",
+        insertDataOption="OVERWRITE",
+        body={"values": [valores]},
+        includeValuesInResponse=True,
+        responseValueRenderOption="UNFORMATTED_VALUE",
+        responseDateTimeRenderOption="SERIAL_NUMBER",
     ).execute()
 
-    values = result.get("values", [])
+    fila = _fila_de_rango(result["updates"]["updatedRange"])
+
+    # Se indexa la descripción tal como la guardó Sheets (USER_ENTERED puede
+    # convertir "1,50" en número, "15/10" en fecha...), que es lo que luego
+    # compara _fila_coincide
+    escritos = result["updates"].get("updatedData", {}).get("values", [[]])[0]
+    if len(escritos) > 2:
+        valores[2] = escritos[2]
+
+    with _LOCK:
+        tx_id = _indexar(tipo, fila, valores)
 
-    # Si no hay datos → usar start_row
-    return start_row + len(values)
+    return tx_id, fila
 
 
 def add_gasto(fecha, importe, descripcion, categoria):
-    service = get_sheets_service()
-    next_row = _find_next_row(service, "B", 5)
+    """Devuelve (id del movimiento, fila escrita)."""
+    return _add_movimiento("Gasto", fecha, importe, descripcion, categoria)
+
 
-    body = {
-        "values": [[str(fecha), importe, descripcion, categoria]]
-    }
+def add_ingreso(fecha, importe, descripcion, categoria):
+    """Devuelve (id del movimiento, fila escrita)."""
+    return _add_movimiento("Ingreso", fecha, importe, descripcion, categoria)
 
-    service.spreadsheets().values().update(
+# ============================================================
+#                 EDITAR / DESHACER MOVIMIENTOS
+# ============================================================
+
+def _fila_coincide(service, mov):
+    """
+    Comprueba que la fila indexada sigue siendo el movimiento
+    (la hoja puede haberse ordenado o editado a mano).
+    """
+    col_ini, col_fin = COLUMNAS[mov["tipo"]]
+    result = service.spreadsheets().values().get(
         spreadsheetId=SPREADSHEET_ID,
-        range=f"Transacciones!B{next_row}:E{next_row}",
-        valueInputOption="USER_ENTERED",
-        body=body,
+        range=f"Transacciones!{col_ini}{mov['fila']}:{col_fin}{mov['fila']}",
+        valueRenderOption="UNFORMATTED_VALUE",
+        dateTimeRenderOption="SERIAL_NUMBER",
     ).execute()
 
+    fila = (result.get("values") or [[]])[0] + ["", "", "", ""]
+    fecha, importe, descripcion = fila[:3]
 
-def add_ingreso(fecha, importe, descripcion, categoria):
+    try:
+        serial = (date.fromisoformat(mov["fecha"]) - EPOCH_SHEETS).days
+    except ValueError:
+        serial = None
+    if fecha != serial and str(fecha) != mov["fecha"]:
+        return False
+
+    try:
+        if abs(float(importe) - float(mov["importe"])) > 0.005:
+            return False
+    except (TypeError, ValueError):
+        return False
+
+    return str(descripcion) == str(mov["descripcion"])
+
+
+def _movimiento_valido(service, tx_id):
+    """Devuelve la entrada del índice si la fila coincide; si no, la descarta."""
+    mov = INDICE["movs"].get(str(tx_id))
+    if mov is None:
+        return None
+
+    if not _fila_coincide(service, mov):
+        del INDICE["movs"][str(tx_id)]
+        save_indice(INDICE)
+        return None
+
+    return mov
+
+
+def editar_movimiento(tx_id, campo, valor):
+    """
+    Modifica un campo del movimiento escribiendo solo su celda.
+    Hace llamadas bloqueantes a la API: desde el bot, vía asyncio.to_thread.
+    """
     service = get_sheets_service()
-    next_row = _find_next_row(service, "G", 5)
 
-    body = {
-        "values": [[str(fecha), importe, descripcion, categoria]]
-    }
+    with _LOCK:
+        mov = _movimiento_valido(service, tx_id)
+        if mov is None:
+            return False
 
-    service.spreadsheets().values().update(
-        spreadsheetId=SPREADSHEET_ID,
-        range=f"Transacciones!G{next_row}:J{next_row}",
-        valueInputOption="USER_ENTERED",
-        body=body,
-    ).execute()
+        col = chr(ord(COLUMNAS[mov["tipo"]][0]) + CAMPOS.index(campo))
+
+        # Texto libre en RAW: se guarda tal cual, sin que Sheets lo
+        # interprete, y así coincide con lo indexado
+        opcion = "RAW" if campo in ("descripcion", "categoria") else "USER_ENTERED"
+
+        service.spreadsheets().values().update(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"Transacciones!{col}{mov['fila']}",
+            valueInputOption=opcion,
+            body={"values": [[valor]]},
+        ).execute()
+
+        mov[campo] = valor
+        save_indice(INDICE)
+    return True
+
+
+def borrar_movimiento(tx_id):
+    """
+    Vacía la fila del movimiento y lo quita del índice.
+    Hace llamadas bloqueantes a la API: desde el bot, vía asyncio.to_thread.
+    """
+    service = get_sheets_service()
+
+    with _LOCK:
+        mov = _movimiento_valido(service, tx_id)
+        if mov is None:
+            return False
+
+        col_ini, col_fin = COLUMNAS[mov["tipo"]]
+
+        service.spreadsheets().values().clear(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f"Transacciones!{col_ini}{mov['fila']}:{col_fin}{mov['fila']}",
+        ).execute()
+
+        del INDICE["movs"][str(tx_id)]
+        save_indice(INDICE)
+    return True